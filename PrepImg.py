@@ -1,5 +1,11 @@
 import os
 import math
+import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+import numpy as np
 from astropy.io import fits
 import warnings
 from glob import glob
@@ -13,13 +19,126 @@ from tweakwcs import fit_wcs, FITSWCS, TPMatch
 from drizzlepac import updatehdr
 import shutil
 
+# fitsio (cfitsio bindings) is much faster than astropy for raw reads,
+# but it is GPL licensed so keep it an optional dependency
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+# JWST filter names look like F090W/F410M etc.
+_FILT_RE = re.compile(r'f\d{3}[wm]')
+
+
+### Helper function _process_map
+### runs a worker over files with a process pool where that is safe
+### spawn-based platforms (macOS, Windows) re-import the calling script in every
+### worker, which re-runs unguarded pipelines, so only fork gets the pool --
+### everything else runs the same workers serially
+
+def _process_map(fn, *iterables, total=None, desc=None):
+    if multiprocessing.get_start_method() == 'fork':
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+            return list(tqdm(ex.map(fn, *iterables), total=total, desc=desc))
+
+    return [fn(*args) for args in tqdm(list(zip(*iterables)), desc=desc)]
+
+
+### Worker function _split_i2d
+### splits a single i2d image into 'sci' and 'wht' files
+### module-level so it can be pickled into worker processes
+
+def _split_i2d(input_image, field, image_dir):
+    m = _FILT_RE.search(os.path.basename(input_image).lower())
+    filt = m.group(0).upper() if m else None
+
+    # read sci and wht with fitsio if available (skips astropy HDU construction)
+    if fitsio is not None:
+        with fitsio.FITS(input_image) as f:
+            ext_data = {'sci': f['sci'].read(), 'wht': f['wht'].read()}
+            header = f['sci'].read_header()
+    else:
+        # only pull the sci and wht extensions instead of materializing the
+        # whole HDU list (i2d files also carry err/con/var extensions)
+        ext_data = {'sci': fits.getdata(input_image, extname='sci'),
+                    'wht': fits.getdata(input_image, extname='wht')}
+        header = fits.getheader(input_image, extname='sci')
+
+    # Only the science extension header has any info including WCS
+    # So we'll just use that for all the output files
+
+    output_images = {}
+    for extension in 'sci wht'.split():
+        output_image = os.path.join(image_dir, f'{field}_{filt}_{extension}.fits')
+        output_images[extension] = output_image
+
+        header['EXTNAME'] = extension
+
+        if fitsio is not None:
+            fitsio.write(output_image, ext_data[extension], header=header, clobber=True)
+        else:
+            fits.writeto(output_image, ext_data[extension], header, overwrite=True,
+                         output_verify='ignore')
+
+    return filt, output_images['sci'], output_images['wht']
+
+
+### Worker function _calc_zp
+### calculates the photometric zeropoint of a single sci image from its pixel size
+
+def _calc_zp(file):
+    # only the header is needed, so never read any data
+    if fitsio is not None:
+        header = fitsio.read_header(file, ext=0)
+    else:
+        header = fits.getheader(file, ext=0)
+
+    pixel_size = header['PIXAR_A2']**0.5
+    zp = 8.9 - 2.5 * math.log10(1e+6 / ( (360 * 3600) / (2 * math.pi * pixel_size) )**2)
+    return zp
+
+
+### Worker function _reproject_to_ref
+### reprojects a single image onto the reference pixel grid
+### the reference header is passed as a serialized string so it is read only once
+
+def _reproject_to_ref(image, ref_header_str, bkgsub=False):
+    ref_header = fits.Header.fromstring(ref_header_str)
+
+    # do_not_scale_image_data skips the BSCALE/BZERO branch on float data
+    hdu = fits.open(image, do_not_scale_image_data=True)
+    data = hdu[0]
+    # keep the input in float32 so no float64 copy is made
+    data.data = data.data.astype('float32', copy=False)
+
+    # interpolate straight into a float32 buffer instead of a float64
+    # temporary that would be downcast at write time
+    shape = (ref_header['NAXIS2'], ref_header['NAXIS1'])
+    reprojected_data = np.empty(shape, dtype=np.float32)
+    reproject_interp(data, ref_header, output_array=reprojected_data)
+
+    # subtract the background before writing so the data only hits disk once
+    # reprojection fills everything outside the input footprint with NaN, so
+    # mask non-finite pixels the same way the standalone bkgsub() does
+    if bkgsub == True:
+        background_map = photutils.Background2D(reprojected_data, 100, filter_size=5,
+                                                coverage_mask=~np.isfinite(reprojected_data),
+                                                fill_value=0.0)
+        reprojected_data -= background_map.background.astype('float32')
+
+    # skip the output verification pass, the header comes straight from the reference
+    fits.writeto(image, reprojected_data, ref_header, overwrite=True, output_verify='ignore')
+    hdu.close()
+
 
 class PrepImg:
     
     ### INITIALIZE
     ### Only inputs are image directory, file naming pattern, and field name
+    ### splitting/zeropoints/reprojection run in parallel worker processes where
+    ### fork is available; on macOS/Windows (spawn) the loops run serially
 
-    def __init__(self, image_dir, file, field, reproject=True, i2d=True):
+    def __init__(self, image_dir, file, field, reproject=True, i2d=True, bkgsub_inline=False):
         # Initialize image locations and future names
         self.image_dir = image_dir
         self.file = file
@@ -27,6 +146,7 @@ class PrepImg:
         self.imfile = f'{self.field}_*_sci.fits'
         self.i2d = i2d
         self.reproject = reproject
+        self.bkgsub_inline = bkgsub_inline
 
         # Create empty data structures
         self.i2d_img = []
@@ -53,33 +173,15 @@ class PrepImg:
         ### SPLIT I2D FILES
         ### Creates 'sci' and 'wht' files from the i2d images
         if self.i2d == True:
-            for input_image in tqdm(self.i2d_img,desc='Saving individual images...'):
-                lowercase_img = os.path.basename(input_image.lower())
-                for i in range(len(lowercase_img)):
-                    if lowercase_img[i] == 'f' and (lowercase_img[i+4] == 'w' or lowercase_img[i+4] == 'm') and lowercase_img[i+1] in '0 1 2 3 4 5 6 7 8 9'.split():
-                        filt = lowercase_img[i:i+5].upper()
-                        self.filts.append(filt)
-                        break
-                
-                hdu_list = fits.open(input_image)
-                header = hdu_list['sci'].header[:]
-                
-                # Only the science extension header has any info including WCS
-                # So we'll just use that for all the output files
-
-                for extension in 'sci wht'.split():
-                    output_image = os.path.join(self.image_dir, f'{self.field}_{filt}_{extension}.fits')
-                    
-                    if extension == 'sci':
-                        self.sci_img.append(output_image)
-                    else:
-                        self.wht_img.append(output_image)
-                    
-                    header['EXTNAME'] = extension
-                    
-                    fits.writeto(output_image, hdu_list[extension].data, header, overwrite=True)
-                
-                hdu_list.close()
+            # each i2d file is independent, so split them across worker processes
+            worker = partial(_split_i2d, field=self.field, image_dir=self.image_dir)
+            results = _process_map(worker, self.i2d_img,
+                                   total=len(self.i2d_img), desc='Saving individual images...')
+
+            for filt, sci_image, wht_image in results:
+                self.filts.append(filt)
+                self.sci_img.append(sci_image)
+                self.wht_img.append(wht_image)
 
         ### PUT SCI AND WHT IMAGES IN LISTS IF THESE ARE SUPPLIED INSTEAD OF I2D
         else:
@@ -88,11 +190,8 @@ class PrepImg:
                 shutil.copy(input_image, new_image)
                 input_image = new_image
 
-                lowercase_img = os.path.basename(input_image.lower())
-                for i in range(len(lowercase_img)):
-                    if lowercase_img[i] == 'f' and (lowercase_img[i+4] == 'w' or lowercase_img[i+4] == 'm') and lowercase_img[i+1] in '0 1 2 3 4 5 6 7 8 9'.split():
-                        filt = lowercase_img[i:i+5].upper()
-                        break
+                m = _FILT_RE.search(os.path.basename(input_image).lower())
+                filt = m.group(0).upper() if m else None
 
                 if 'sci' in input_image.lower() or 'drz' in input_image.lower():
                     self.sci_img.append(input_image)
@@ -108,16 +207,8 @@ class PrepImg:
         ### Use pixel size in image header to calculate photometric zeropoints for SW and LW filters
         ### If SW and LW images have the same pixel size, zp_sw == zp_lw
 
-        zeropoints = []
-        for file in tqdm(self.sci_img, desc="Calculating zeropoints..."):
-            hdul = fits.open(file)
-            header = hdul[0].header
-                        
-            pixel_size = header['PIXAR_A2']**0.5
-            zp = 8.9 - 2.5 * math.log10(1e+6 / ( (360 * 3600) / (2 * math.pi * pixel_size) )**2)
-            zeropoints.append(zp)
-                
-            hdul.close()
+        zeropoints = _process_map(_calc_zp, self.sci_img,
+                                  total=len(self.sci_img), desc='Calculating zeropoints...')
             
         self.zp_sw = max(zeropoints)
         self.zp_lw = min(zeropoints)
@@ -127,20 +218,30 @@ class PrepImg:
 
         if self.reproject == True:
             images = self.sci_img + self.wht_img
-            for image in tqdm(images, desc='Reprojecting pixel grids...'):
-                ref_image = self.sci_img[0]
 
-                hdul = fits.open(ref_image)
-                ref_header = hdul['sci'].header
+            # serialize the reference header once instead of reopening it per image
+            ref_image = self.sci_img[0]
+            with fits.open(ref_image) as ref_hdul:
+                ref_header_str = ref_hdul['sci'].header.tostring()
 
-                hdu = fits.open(image)
-                data = hdu[0]
+            # only sci images get the inline background subtraction
+            bkg_flags = [self.bkgsub_inline] * len(self.sci_img) + [False] * len(self.wht_img)
 
-                reprojected_data, footprint = reproject_interp(data, ref_header)
-                
-                fits.writeto(image, reprojected_data.astype('float32'), ref_header, overwrite=True)
-                hdu.close()
-                hdul.close()
+            # the reference filter images already sit on the reference grid, and
+            # reprojecting an image onto its own WCS is a no-op that still pays
+            # the full interpolation cost - skip them, unless the reference sci
+            # still needs its inline background subtraction
+            skip = {os.path.abspath(ref_image)}
+            if len(self.wht_img) > 0:
+                skip.add(os.path.abspath(self.wht_img[0]))
+
+            pairs = [(image, bkg) for image, bkg in zip(images, bkg_flags)
+                     if os.path.abspath(image) not in skip or bkg == True]
+            images = [pair[0] for pair in pairs]
+            bkg_flags = [pair[1] for pair in pairs]
+
+            _process_map(_reproject_to_ref, images, repeat(ref_header_str), bkg_flags,
+                         total=len(images), desc='Reprojecting pixel grids...')
 
         ### DONE SPLITTING AND REPROJECTING
         ### Print
@@ -151,13 +252,20 @@ class PrepImg:
     ### Method bkgsub
     ### optionally subtract the background from the science images
     ### size is the size of each square that background is measured and subtracted from
+    ### bkgsub_inline=True in the constructor does this during reprojection instead,
+    ### which avoids reading and writing every sci image a second time
 
     def bkgsub(self, size=100):
         for image in tqdm(self.sci_img, desc='Background Subtraction...'):
             hdul = fits.open(image)
             data = hdul['sci'].data
 
-            background_map = photutils.Background2D(data, size, filter_size=5)  
+            # each filter has its own footprint (chip gaps, dithers), so the
+            # empty-coverage mask must come from this image, not a shared one
+            coverage_mask = ~np.isfinite(data)
+
+            background_map = photutils.Background2D(data, size, filter_size=5,
+                                                    coverage_mask=coverage_mask, fill_value=0.0)
             data = data - background_map.background.astype('float32')
 
             hdul['sci'].data = data
@@ -202,14 +310,17 @@ class PrepImg:
                     self.cats.append(file)
 
         # set up reference filter images
+        # copy the header so the reference file is opened exactly once
         ref_image = self.sci_img[ref_idx]
-        ref_hdul = fits.open(ref_image)
-        ref_header = ref_hdul[0].header
-#        ref_wcs = HSTWCS(ref_hdul, 0)
+        with fits.open(ref_image) as ref_hdul:
+            ref_header = ref_hdul[0].header.copy()
+#            ref_wcs = HSTWCS(ref_hdul, 0)
 
         # reference filter catalog
+        # only parse the position columns, the rest of the catalog is unused
         ref_catfile = self.cats[ref_idx]
-        ref_cat = Table.read(ref_catfile, format='ascii')
+        ref_cat = Table.read(ref_catfile, format='ascii',
+                             include_names=['X_IMAGE', 'Y_IMAGE', 'ALPHA_J2000', 'DELTA_J2000'])
         ref_cat.rename_column('X_IMAGE', 'x')
         ref_cat.rename_column('Y_IMAGE', 'y')
         ref_cat.rename_column('ALPHA_J2000', 'RA')
@@ -219,6 +330,9 @@ class PrepImg:
             filt = self.filts[idx]
 
             # make sure input filter isn't same as reference filter:
+            # (no further skip for images whose WCS matches the reference within a
+            # tolerance -- after fit_wcs the tweaked WCS essentially never lands
+            # exactly on the reference grid, so reprojection is not a no-op here)
             if idx == ref_idx:
                 continue
 
@@ -229,34 +343,23 @@ class PrepImg:
             input_wht_hdul = fits.open(wht_image)
 #            input_header = input_hdul[0].header
             input_wcs = HSTWCS(input_hdul, 0)
+            # the corrector does not depend on the match offsets,
+            # so build it once per image and reuse it for match and fit
+            input_wcs_corrector = FITSWCS(input_wcs)
 
             # input filter catalog
             input_catfile = self.cats[idx]
-            input_cat = Table.read(input_catfile, format='ascii')
+            input_cat = Table.read(input_catfile, format='ascii',
+                                   include_names=['X_IMAGE', 'Y_IMAGE', 'ALPHA_J2000', 'DELTA_J2000'])
             input_cat.rename_column('X_IMAGE', 'x')
             input_cat.rename_column('Y_IMAGE', 'y')
             input_cat.rename_column('ALPHA_J2000', 'RA')
             input_cat.rename_column('DELTA_J2000', 'DEC')
 
-            # match catalogs with loop
-            xi_best = 0
-            yi_best = 0
-            matches_best = 0
-
-            for xi in range(-3, 3):
-                for yi in range(-3, 3):
-                    match = TPMatch(searchrad=10, separation=1, tolerance=2, use2dhist=True, xoffset=xi, yoffset=yi)
-                    input_wcs_corrector = FITSWCS(input_wcs)
-                    ridx, iidx = match(ref_cat, input_cat, input_wcs_corrector)
-
-                    if len(ridx) >= matches_best:
-                        xi_best = xi
-                        yi_best = yi
-                        matches_best = len(ridx)
-            
-            # match catalogs based on best offset
-            match = TPMatch(searchrad=10, separation=1, tolerance=2, use2dhist=True, xoffset=xi_best, yoffset=yi_best)
-            input_wcs_corrector = FITSWCS(input_wcs)
+            # match catalogs
+            # the 2D histogram finds the best offset itself, so a single match
+            # with a wide search radius replaces scanning a grid of offsets
+            match = TPMatch(searchrad=15, separation=1, tolerance=2, use2dhist=True, xoffset=0, yoffset=0)
             ridx, iidx = match(ref_cat, input_cat, input_wcs_corrector)
 
             # make sure number of matches isn't bad
@@ -270,13 +373,18 @@ class PrepImg:
                 updatehdr.update_wcs(input_hdul, 0, aligned_imwcs, wcsname='TWEAK', reusename=True, verbose=False)
                 updatehdr.update_wcs(input_wht_hdul, 0, aligned_imwcs, wcsname='TWEAK', reusename=True, verbose=False)
                 
+                # reproject into preallocated float32 buffers so neither a float64
+                # temporary nor an astype copy is ever made
+                shape = (ref_header['NAXIS2'], ref_header['NAXIS1'])
                 # reproject sci
-                reprojected_data, footprint = reproject_interp(input_hdul[0], ref_header)
-                fits.writeto(input_image, reprojected_data.astype('float32'), ref_header, overwrite=True)
+                reprojected_data = np.empty(shape, dtype=np.float32)
+                reproject_interp(input_hdul[0], ref_header, output_array=reprojected_data)
+                fits.writeto(input_image, reprojected_data, ref_header,
+                             overwrite=True, output_verify='ignore')
                 # reproject wht
-                reprojected_data, footprint = reproject_interp(input_wht_hdul[0], ref_header)
-                fits.writeto(wht_image, reprojected_data.astype('float32'), ref_header, overwrite=True)
+                reprojected_data = np.empty(shape, dtype=np.float32)
+                reproject_interp(input_wht_hdul[0], ref_header, output_array=reprojected_data)
+                fits.writeto(wht_image, reprojected_data, ref_header,
+                             overwrite=True, output_verify='ignore')
 
             input_hdul.close()
-        
-        ref_hdul.close()
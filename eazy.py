@@ -1,10 +1,63 @@
 import os
+import math
+import subprocess
+from itertools import islice
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MultipleLocator
+from astropy.io import fits
 from astropy.table import Table
 from glob import glob
 
+# pandas' C parser reads the small EAZY ASCII files much faster than
+# astropy.io.ascii, but keep it optional
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# numba fuses the mag -> flux conversion into one parallel pass over the rows,
+# which beats the NumPy version on very large catalogs; also optional
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    ### jitted kernel for convertFluxes
+
+    @njit(parallel=True, fastmath=True)
+    def _mags_to_fluxes(mag, err, out_flux, out_err):
+        for i in prange(len(mag)):
+            if mag[i] < 1:
+                # mag < 1 means non-detection
+                out_flux[i] = -100.0
+                out_err[i] = 0.0
+            else:
+                f = 10**(-0.4*(mag[i]+48.6)) * 1e29
+                out_flux[i] = f
+                out_err[i] = (2.5/math.log(10))*err[i]*f
+
+
+### Function _read_ascii
+### reads a whitespace-delimited EAZY output file
+### column names come from the first commented line, like astropy's commented_header
+
+def _read_ascii(path):
+    if pd is None:
+        return Table.read(path, format='ascii')
+
+    with open(path, 'r') as f:
+        names = f.readline().lstrip('#').split()
+
+    return pd.read_csv(path, sep=r'\s+', comment='#', engine='c', names=names)
+
+
+# lower wavelength edges [angstrom] and response widths for
+# F090W, F150W, F200W, F277W, F356W, F444W
+_FILT_EDGES = np.array([0.9e+04, 1.5e+04, 1.9e+04, 2.7e+04, 3.5e+04, 4.4e+04])
+_FILT_WIDTHS = np.array([0.105, 0.169, 0.236, 0.356, 0.42, 0.553]) * 10**4
+
 class Eazy:
     
     ### INITIALIZE
@@ -31,13 +84,28 @@ class Eazy:
     def convertFluxes(self, filts):
         final_table = Table.read(self.params['CATALOG_FILE'], format='ascii')
         for filt in filts:
-            for i in range(len(final_table[filt])):
-                if final_table[filt][i] < 1:
-                    final_table[filt][i] = -100
-                    final_table[filt + '_err'][i] = 0
-                else:
-                    final_table[filt][i] = (10**(-0.4*(final_table[filt][i]+48.6)))*1e-7*1e4*1e26*1e6
-                    final_table[filt + '_err'][i] = (2.5/np.log(10))*final_table[filt + '_err'][i]*(final_table[filt][i])
+            mag = np.asarray(final_table[filt], dtype=float)
+            err = np.asarray(final_table[filt + '_err'], dtype=float)
+
+            if njit is not None:
+                # single fused pass, spread across cores
+                flux = np.empty_like(mag)
+                new_err = np.empty_like(mag)
+                _mags_to_fluxes(mag, err, flux, new_err)
+
+                final_table[filt] = flux
+                final_table[filt + '_err'] = new_err
+
+            else:
+                # mag < 1 means non-detection
+                mask = mag < 1
+
+                # erg/s/cm2/Hz -> nJy conversion factor is 1e-7*1e4*1e26*1e6 = 1e29
+                flux = 10**(-0.4*(mag+48.6)) * 1e29
+                new_err = (2.5/np.log(10)) * err * flux
+
+                final_table[filt] = np.where(mask, -100, flux)
+                final_table[filt + '_err'] = np.where(mask, 0, new_err)
 
         final_table.rename_column('id', '#id')
         final_table.write(self.params['CATALOG_FILE'].replace('.txt', '_flux.txt'), format='ascii', overwrite=True)
@@ -46,18 +114,29 @@ class Eazy:
     ### Method run
     ### run eazy
     ### can do it with or without a logfile
+    ### wait=False returns the Popen handle so several fields can run at once
 
-    def run(self, logfile=True):
+    def run(self, logfile=True, wait=True):
         # make output directory
         if not os.path.exists(self.eazypath + '/' + self.output_dir):
             os.mkdir(self.eazypath + '/' + self.output_dir)
 
         self.logfile = logfile
-        os.chdir(self.eazypath)
+
+        # run from eazypath via cwd= instead of os.chdir, no shell involved
         if self.logfile == False:
-            os.system('../src/eazy')
+            proc = subprocess.Popen(['../src/eazy'], cwd=self.eazypath)
         else:
-            os.system('../src/eazy > logfile')
+            log = open(os.path.join(self.eazypath, 'logfile'), 'wb')
+            proc = subprocess.Popen(['../src/eazy'], stdout=log, stderr=subprocess.STDOUT,
+                                    cwd=self.eazypath)
+
+        if wait == False:
+            return proc
+
+        proc.wait()
+        if self.logfile == True:
+            log.close()
         
     ### Method makeplots
     ### main plotting function
@@ -66,6 +145,17 @@ class Eazy:
         self.output_dir = output_dir
         namestyle = 'photz_' # for EAZY output files
 
+        # imrgb can be an array or a path to the RGB image on disk
+        # .npy and .fits files are memory mapped, so only the pixels each
+        # cutout actually touches ever get paged in
+        if type(imrgb) == str:
+            if imrgb.endswith('.npy'):
+                imrgb = np.load(imrgb, mmap_mode='r')
+            elif imrgb.endswith('.fits'):
+                imrgb = fits.getdata(imrgb, memmap=True)
+            else:
+                imrgb = plt.imread(imrgb)
+
         # retreive files and get id numbers
         files = glob(os.path.join(output_dir, namestyle + "*.obs_sed"))
         
@@ -80,7 +170,18 @@ class Eazy:
         # get SExtractor matched catalog file for object positions
         catfile = self.params['CATALOG_FILE']
         t = Table.read(catfile, format='ascii')
-        
+
+        # build the id -> row index once instead of scanning the catalog per galaxy
+        id_to_row = {int(t['id'][i]): i for i in range(len(t))}
+
+        # one figure reused for every galaxy, the axes get cleared each iteration
+        # (building a fresh figure per galaxy dominates plotting time)
+        fig, ax = plt.subplots(1,3)
+        fig.set_size_inches(15,5)
+        # minor tick locators
+        ml1 = MultipleLocator(0.2*10**4)
+        ml2 = MultipleLocator(0.5)
+
         # loop through high-z objects
         for idx in id_list:
             # three EAZY files per object
@@ -92,9 +193,10 @@ class Eazy:
                 print(f'{obs_sed} is not a file, skipping...')
                 continue
 
-            # open template sed file
-            temp_hl = open(temp_sed, 'r')
-            lines = temp_hl.readlines()
+            # the redshifts sit in the first three lines of the template sed file,
+            # so only read those instead of the whole file
+            with open(temp_sed, 'r') as temp_hl:
+                lines = list(islice(temp_hl, 3))
             z_a = lines[1].split()[1] # redshift
             z_p = lines[2].split()[1] # redshift with prior
 
@@ -104,12 +206,10 @@ class Eazy:
             if z_p == 'z_prior=':
                 z_p += lines[2].split()[2]
 
-            temp_hl.close()
-
             # make seds and P(z) into tables
-            obs_sed = Table.read(obs_sed, format='ascii')
-            pz = Table.read(pz, format='ascii')
-            temp_sed = Table.read(temp_sed, format='ascii')
+            obs_sed = _read_ascii(obs_sed)
+            pz = _read_ascii(pz)
+            temp_sed = _read_ascii(temp_sed)
 
             # get main parameters from the tables
             lamb_sed = temp_sed['lambda']
@@ -121,37 +221,21 @@ class Eazy:
             p_z = pz['pz']
 
             ### filter response widths
-            filter_width = []
-            for i in lamb_img:
-                if i - 4.4e+04 > 0: # F444W
-                    filter_width.append(0.553*10**4)
-                #elif i - 4e+04 > 0: # F410M
-                #    filter_width.append(0.219*10**4)
-                elif i - 3.5e+04 > 0: # F356W
-                    filter_width.append(0.42*10**4)
-                elif i - 2.7e+04 > 0: # F277W
-                    filter_width.append(0.356*10**4)
-                elif i - 1.9e+04 > 0: # F200W
-                    filter_width.append(0.236*10**4)
-                elif i - 1.5e+04 > 0: # F150W
-                    filter_width.append(0.169*10**4)
-                #elif i - 1.15e+04 > 0: # F115W
-                #    filter_width.append(0.135*10**4)
-                elif i - 0.9e+04 > 0: # F090W
-                    filter_width.append(0.105*10**4)
+            ### one searchsorted lookup instead of a chain of comparisons per filter
+            ### clip so wavelengths below the bluest edge don't wrap to index -1
+            edge_idx = np.searchsorted(_FILT_EDGES, np.asarray(lamb_img), side='right') - 1
+            filter_width = _FILT_WIDTHS[np.clip(edge_idx, 0, None)]
 
             ### Color image
-            row = np.array(t[np.where(t['id'] == idx)]) # sort from table of objects
-            xpos = imrgb.shape[0] - int(row['Y'][0]) #rgb image coords are weird
-            ypos = int(row['X'][0])
+            row = id_to_row[int(idx)] # look up in table of objects
+            xpos = imrgb.shape[0] - int(t['Y'][row]) #rgb image coords are weird
+            ypos = int(t['X'][row])
             rgb = imrgb[(xpos-40):(xpos+40), (ypos-40):(ypos+40)] #make 40x40 pixel cutout
             
             ### Plot
-            fig, ax = plt.subplots(1,3)    
-            fig.set_size_inches(15,5)
-            # minor tick locators
-            ml1 = MultipleLocator(0.2*10**4)
-            ml2 = MultipleLocator(0.5)
+            # clearing also resets ticks, so tick setup below reruns every iteration
+            for axis in ax:
+                axis.clear()
 
             # first plot (SED)
             # template SED